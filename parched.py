@@ -27,13 +27,34 @@ classes iniherit from the :class:`Package` class, which provides the basic
 metadata about package.
 """
 
+import os
 import tarfile
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache, partial
 import re
-import shlex
+from sys import intern
 
 __all__ = ['Package', 'PacmanPackage', 'PKGBUILD']
 
+# Record buffer used when a package has to be read in stream mode. The
+# default of 10 KiB means many small reads through the decompressor.
+_STREAM_BUFSIZE = 10240 * 64
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+@lru_cache(maxsize=1024)
+def _utcfromtimestamp(timestamp):
+    """Return a naive UTC :class:`datetime` for a POSIX *timestamp*
+
+    Packages built in the same batch share build dates, so results are
+    cached.
+
+    """
+    return _EPOCH + timedelta(seconds=timestamp)
+
 class Package(object):
     """An abstract package class
     This class provides no functionality whatsoever. Use either
@@ -108,6 +129,24 @@ class Package(object):
     For more information about these attributes see :manpage:`PKGBUILD(5)`.
 
     """
+    __slots__ = (
+        'name',
+        'version',
+        'release',
+        'description',
+        'url',
+        'licenses',
+        'groups',
+        'provides',
+        'depends',
+        'optdepends',
+        'conflicts',
+        'replaces',
+        'architectures',
+        'options',
+        'backup',
+    )
+
     def __init__(self, pkgfile):
         super(Package, self).__init__()
         self.name = ""
@@ -141,19 +180,28 @@ class PacmanPackage(Package):
         >>> import parched
         >>> package = PacmanPackage("foo-1.0-1-any.tar.gz")
 
+    The package file is only opened and read when its metadata is first
+    accessed, so errors reading it are raised at that point. Since any
+    variable in `.PKGINFO` may become an attribute, looking up any other
+    missing attribute, e.g. with :func:`hasattr`, also loads the package
+    first. So does pickling or copying a package which has not been loaded.
+
     If *tarfileobj* is specified, it is used as an alternative to a
     :class:`TarFile` like object opened for *name*. It is supposed to be
     at position 0. *tarfileobj* may be any object that has an
-    :meth:`extractfile` method, which returns a file like object::
+    :meth:`extractfile` method, which returns a file like object. It should
+    also be opened in random access mode (e.g. ``"r:*"``), since stream mode
+    is considerably slower for member lookups::
 
         >>> import tarfile
-        >>> f = tarfile.open("foo-1.0-1-any.tar.gz", "r|gz")
+        >>> f = tarfile.open("foo-1.0-1-any.tar.gz", "r:gz")
         >>> package = PacmanPackage(tarfileobj=f)
         >>> f.close()
 
     .. note::
 
-        *tarfileobj* is not closed.
+        *tarfileobj* is not closed. It must be left open if :attr:`files`
+        is going to be accessed.
 
     The packages metadata can then be accessed directly::
     
@@ -182,78 +230,230 @@ class PacmanPackage(Package):
     
     .. attribute:: files
     
-        An array of files contained in the package
+        An array of files contained in the package. The list is only built
+        when the attribute is first accessed, as it requires reading every
+        member header in the archive.
 
     """
+    # Other variables found in .PKGINFO are stored in __dict__
+    __slots__ = (
+        'builddate',
+        'packager',
+        'is_forced',
+        'size',
+        '_name',
+        '_tarfileobj',
+        '_files',
+        '_loaded',
+        '__dict__',
+    )
+    _symbol_map = {
+        'pkgname': 'name',
+        'pkgver': 'version',
+        'pkgdesc': 'description',
+        'license': 'licenses',
+        'arch': 'architectures',
+        'force': 'is_forced',
+        'conflict': 'conflicts',
+        'group': 'groups',
+        'optdepend': 'optdepends',
+        'makepkgopt': 'options',
+        'depend': 'depends',
+    }
+    _arrays = frozenset((
+        'arch',
+        'license',
+        'replaces',
+        'group',
+        'depend',
+        'optdepend',
+        'conflict',
+        'provides',
+        'backup',
+        'makepkgopt',
+    ))
+    # Attributes set when the package is loaded, other than the variables
+    # which are only stored in __dict__
+    _metadata = Package.__slots__ + (
+        'builddate',
+        'packager',
+        'is_forced',
+        'size',
+    )
+    # Values of these variables recur across many packages, and are interned
+    # so that they are shared between instances
+    _interned = frozenset((
+        'pkgname',
+        'packager',
+        'arch',
+        'license',
+        'replaces',
+        'group',
+        'depend',
+        'optdepend',
+        'conflict',
+        'provides',
+        'makepkgopt',
+    ))
+    # Specialized lookup tables, computed once from the above. Scalar
+    # variables map to the attribute they are stored in, and array variables
+    # are paired with their list attribute.
+    _scalar_attrs = {}
+    _array_attrs = []
+    for _var in _symbol_map:
+        if _var not in _arrays:
+            _scalar_attrs[_var] = _symbol_map[_var]
+    for _var in _arrays:
+        _array_attrs.append((_var, _symbol_map.get(_var, _var)))
+    _array_attrs = tuple(_array_attrs)
+    del _var
+
     def __init__(self, name=None, tarfileobj=None):
-        super(PacmanPackage, self).__init__(tarfileobj)
+        if not name and not tarfileobj:
+            raise ValueError("nothing to open")
+        self._name = name
+        self._tarfileobj = tarfileobj
+        self._files = None
+        self._loaded = False
+        # The caller may close tarfileobj as soon as we return, so only
+        # packages opened by name are loaded lazily
+        if tarfileobj:
+            self._load()
+
+    def __getattr__(self, name):
+        # Only called for attributes which are not set, i.e. metadata of a
+        # package which has not been loaded yet. Unknown names load the
+        # package too, as they may be variables from .PKGINFO.
+        if name.startswith('_') or self._loaded:
+            raise AttributeError(name)
+        self._load()
+        return getattr(self, name)
+
+    def __str__(self):
+        return f'{self.name} {self.version}-{self.release}'
+
+    @classmethod
+    def parse_many(cls, names, workers=None):
+        """Return a list of packages parsed from the file paths in *names*
+
+        The packages are parsed in parallel by a pool of *workers*
+        processes, which defaults to the number of processors. Processes are
+        used rather than threads because only decompression releases the
+        GIL, parsing does not.
+
+        """
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(partial(_load_package, cls), names,
+                chunksize=16))
+
+    @property
+    def files(self):
+        if self._files is None:
+            if self._tarfileobj:
+                self._files = self._tarfileobj.getnames()
+            else:
+                with self._open(self._name) as tarfileobj:
+                    self._files = tarfileobj.getnames()
+        return self._files
+
+    def _load(self):
+        """Read the package metadata from .PKGINFO"""
+        super(PacmanPackage, self).__init__(self._tarfileobj)
         self.builddate = ""
         self.packager = ""
         self.is_forced = ""
         self.size = 0
-        self.files = []
-        self._symbol_map = {
-            'pkgname': 'name',
-            'pkgver': 'version',
-            'pkgdesc': 'description',
-            'license': 'licenses',
-            'arch': 'architectures',
-            'force': 'is_forced',
-            'conflict': 'conflicts',
-            'group': 'groups',
-            'optdepend': 'optdepends',
-            'makepkgopt': 'options',
-            'depend': 'depends',
-        }
-        self._arrays = (
-            'arch',
-            'license',
-            'replaces',
-            'group',
-            'depend',
-            'optdepend',
-            'conflict',
-            'provides',
-            'backup',
-            'makepkgopt',
-        )
-        if not name and not tarfileobj:
-            raise ValueError("nothing to open")
-        should_close = False
-        if not tarfileobj:
-            tarfileobj = tarfile.open(str(name), "r|*")
-            should_close = True
-        pkginfo = tarfileobj.extractfile(".PKGINFO")
-        self.files = tarfileobj.getnames()
-        self._parse(pkginfo)
-        if should_close:
-            tarfileobj.close()
+        try:
+            if self._tarfileobj:
+                self._parse(self._extract_pkginfo(self._tarfileobj))
+            else:
+                with self._open(self._name) as tarfileobj:
+                    self._parse(self._extract_pkginfo(tarfileobj))
+        except BaseException:
+            # Unset the metadata again, so that it isn't mistaken for that
+            # of the package and the next access retries loading
+            self._unload()
+            raise
+        self._loaded = True
+
+    def _unload(self):
+        """Unset all metadata attributes"""
+        for attr in self._metadata:
+            try:
+                delattr(self, attr)
+            except AttributeError:
+                pass
+        self.__dict__.clear()
+
+    @contextmanager
+    def _open(self, name):
+        """Open the package tarball *name*, closing it when done"""
+        with open(os.fspath(name), "rb") as fileobj:
+            # Stream mode is only used for files which can't be seeked, such
+            # as pipes. Random access mode would reopen those by name for
+            # every compression method it tries.
+            if fileobj.seekable():
+                tarfileobj = tarfile.open(fileobj=fileobj, mode="r:*")
+            else:
+                tarfileobj = tarfile.open(fileobj=fileobj, mode="r|*",
+                    bufsize=_STREAM_BUFSIZE)
+            try:
+                yield tarfileobj
+            finally:
+                tarfileobj.close()
 
-    def __str__(self):
-        return '%s %s-%s' % (self.name, self.version, self.release)
+    def _extract_pkginfo(self, tarfileobj):
+        """Return a file object for the .PKGINFO member
+
+        Members are iterated so that the search stops as soon as .PKGINFO
+        is found, which is usually the first member, instead of reading
+        every header in the archive.
+
+        """
+        try:
+            members = iter(tarfileobj)
+        except TypeError:
+            return tarfileobj.extractfile(".PKGINFO")
+        for member in members:
+            if member.name == ".PKGINFO":
+                return tarfileobj.extractfile(member)
+        raise KeyError("filename '.PKGINFO' not found")
 
     def _parse(self, pkginfo):
         """Parse the .PKGINFO file"""
-        if hasattr(pkginfo, "seek"):
+        # Members of archives read in stream mode can't be seeked
+        if hasattr(pkginfo, "seek") and pkginfo.tell():
             pkginfo.seek(0)
-        for line in pkginfo:
-            if line[0] == '#' or line.strip() == '':
+        data = pkginfo.read()
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
+        scalar_attrs = self._scalar_attrs
+        interned = self._interned
+        # Bind the append methods of this instance's lists up front, so that
+        # an array line costs a single lookup and a call into C
+        appenders = {}
+        for var, attr in self._array_attrs:
+            appenders[var] = getattr(self, attr).append
+        # Only newlines end a line, unlike with splitlines()
+        for line in data.split('\n'):
+            line = line.strip()
+            if not line or line[0] == '#':
+                continue
+            var, sep, value = line.partition(' = ')
+            if not sep:
                 continue
-            var, _, value = line.strip().rpartition(' = ')
-            real_name = var
-            if var in self._symbol_map:
-                real_name = self._symbol_map[var]
-            if var in self._arrays:
-                array = getattr(self, real_name)
-                array.append(value)
+            if var in interned:
+                value = intern(value)
+            append = appenders.get(var)
+            if append is not None:
+                append(value)
             else:
-                setattr(self, real_name, value)
+                setattr(self, scalar_attrs.get(var, var), value)
         if self.size:
             self.size = int(self.size)
-        if not self.is_forced == False:
-            self.is_forced = self.is_forced == "True"
+        self.is_forced = self.is_forced == "True"
         if self.builddate:
-            self.builddate = datetime.utcfromtimestamp(int(self.builddate))
+            self.builddate = _utcfromtimestamp(int(self.builddate))
         if self.version:
             self.version, _, self.release = self.version.rpartition('-')
             self.release = int(self.release)
@@ -261,6 +461,14 @@ class PacmanPackage(Package):
             self.packager = None
 
 
+def _load_package(cls, name):
+    """Return a package of type *cls* read from *name*, with its metadata
+    loaded"""
+    package = cls(name)
+    package._load()
+    return package
+
+
 class PKGBUILD(Package):
     """A :manpage:`PKGBUILD(5)` parser
 
@@ -323,7 +531,66 @@ class PKGBUILD(Package):
         the basenames of the URIs in :attr:`sources`
 
     """
+    # Other variables defined in the PKGBUILD are stored in __dict__
+    __slots__ = (
+        'install',
+        'checksums',
+        'noextract',
+        'sources',
+        'makedepends',
+        '_symbols',
+        '_resolving',
+        '_resolved',
+        '__dict__',
+    )
+    # Symbol lookup table
+    _var_map = {
+        'pkgname': 'name',
+        'pkgver': 'version',
+        'pkgdesc': 'description',
+        'pkgrel': 'release',
+        'source': 'sources',
+        'arch': 'architectures',
+        'license': 'licenses',
+    }
+    _checksum_fields = frozenset((
+        'md5sums',
+        'sha1sums',
+        'sha256sums',
+        'sha384sums',
+        'sha512sums',
+    ))
     _symbol_regex = re.compile(r"\$(?P<name>{[\w\d_]+}|[\w\d]+)")
+    # Comments, quoted strings, function definitions and assignments at the
+    # start of a command. Only the latter two are of interest, the others
+    # are matched so that their contents are skipped.
+    _token_regex = re.compile(r"""
+        (?P<comment>(?<![^\s;])\#[^\n]*)
+        | (?P<quoted>"(?:[^"\\]|\\.)*"|'[^']*')
+        | (?P<function>(?<![^\s;])
+            (?:function\s+[^\s(){}]+(?:\s*\(\))?|[^\s(){}=;"'$]+\s*\(\))
+            \s*\{)
+        | (?<![^\s;])(?P<name>[A-Za-z_]\w*)=
+            (?:\((?P<array>(?:"(?:[^"\\]|\\.)*"|'[^']*'|\\.
+                |(?<![^\s(])\#[^\n]*(?![^\n])|(?<=[^\s(])\#
+                |[^)"'\\\#])*)\)
+            |(?P<value>(?:"(?:[^"\\]|\\.)*"|'[^']*'|\\[^\n]
+                |[^\s"'\;&|()<>])*))
+        """, re.S | re.X)
+    # Tokens which may contain braces that do not delimit a function body
+    _body_regex = re.compile(r"""
+        "(?:[^"\\]|\\.)*"|'[^']*'|\\.|(?<![^\s;])\#[^\n]*|[{}]
+        """, re.S | re.X)
+    # Words and comments within an array. Escaped newlines separate words.
+    _word_regex = re.compile(r"""
+        (?P<comment>\#[^\n]*)
+        | (?P<word>(?:"(?:[^"\\]|\\.)*"|'[^']*'|\\[^\n]|[^\s"'\\])+)
+        """, re.S | re.X)
+    _quoted_regex = re.compile(r"""
+        "((?:[^"\\]|\\.)*)"|'([^']*)'|\\(.)
+        """, re.S | re.X)
+    # Characters which may be escaped within double quotes
+    _escape_regex = re.compile(r'\\([$`"\\\n])')
 
     def __init__(self, name=None, fileobj=None):
         super(PKGBUILD, self).__init__(fileobj)
@@ -338,26 +605,11 @@ class PKGBUILD(Package):
         self.noextract = []
         self.sources = []
         self.makedepends = []
-
-        # Symbol lookup table
-        self._var_map = {
-            'pkgname': 'name',
-            'pkgver': 'version',
-            'pkgdesc': 'description',
-            'pkgrel': 'release',
-            'source': 'sources',
-            'arch': 'architectures',
-            'license': 'licenses',
-        }
-        self._checksum_fields = (
-            'md5sums',
-            'sha1sums',
-            'sha256sums',
-            'sha384sums',
-            'sha512sums',
-        )
         # Symbol table
         self._symbols = {}
+        # Symbols being substituted, and those already substituted
+        self._resolving = set()
+        self._resolved = set()
 
         if not name and not fileobj:
             raise ValueError("nothing to open")
@@ -369,96 +621,117 @@ class PKGBUILD(Package):
         if should_close:
             fileobj.close()
 
-    def _handle_assign(self, token):
-        var, equals, value = token.strip().partition('=')
-        # Is it an array?
-        if value[0] == '(' and value[-1] == ')':
-            self._symbols[var] = self._clean_array(value)
+    def _handle_assign(self, matchobj):
+        """Store a regex-matched assignment in the symbol table"""
+        var = matchobj.group('name')
+        if matchobj.group('array') is not None:
+            self._symbols[var] = self._clean_array(matchobj.group('array'))
         else:
-            self._symbols[var] = self._clean(value)
+            self._symbols[var] = self._clean(matchobj.group('value'))
+
+    def _skip_function(self, text, pos):
+        """Return the position after the body of a function starting at
+        *pos*, which is just after its opening brace."""
+        depth = 1
+        for matchobj in self._body_regex.finditer(text, pos):
+            token = matchobj.group()
+            if token == '{':
+                depth += 1
+            elif token == '}':
+                depth -= 1
+                if not depth:
+                    return matchobj.end()
+        return len(text)
 
     def _parse(self, fileobj):
         """Parse PKGBUILD"""
         if hasattr(fileobj, "seek"):
             fileobj.seek(0)
-        parser = shlex.shlex(fileobj, posix=True)
-        parser.whitespace_split = True
-        in_function = False
+        text = fileobj.read()
+        pos = 0
+        search = self._token_regex.search
         while 1:
-            token = parser.get_token()
-            if token is None or token == '':
+            matchobj = search(text, pos)
+            if matchobj is None:
                 break
-            # Skip escaped newlines and functions
-            if token == '\n' or in_function:
-                continue
-            # Special case:
-            # Array elements are dispersed among tokens, we have to join
-            # them first
-            if token.find("=(") >= 0 and not token.rfind(")") >= 0:
-                in_array = True
-                elements = []
-                while in_array:
-                    _token = parser.get_token()
-                    if _token == '\n':
-                        continue
-                    if _token[-1] == ')':
-                        _token = '"%s")' % _token.strip(')')
-                        token = token.replace('=(', '=("', 1) + '"'
-                        token = " ".join((token, " ".join(elements), _token))
-                        in_array = False
-                    else:
-                        elements.append('"%s"' % _token.strip())
-            # Assignment
-            if re.match(r"^[\w\d_]+=", token):
-                self._handle_assign(token)
-            # Function definitions
-            elif token == '{':
-                in_function = True
-            elif token == '}' and in_function:
-                in_function = False
+            pos = matchobj.end()
+            # Function bodies are skipped entirely
+            if matchobj.group('function'):
+                pos = self._skip_function(text, pos)
+            elif matchobj.group('name'):
+                self._handle_assign(matchobj)
         self._substitute()
         self._assign_local()
         if self.release:
             self.release = float(self.release)
 
-    def _clean(self, value):
-        """Pythonize a bash string.
-
-        shlex strips enclosing double quotes from right-hand side of
-        assignment, but not enclosing single quotes.
+    def _unquote(self, matchobj):
+        """Replace a regex-matched quoted string or escape with its value"""
+        double, single, escaped = matchobj.groups()
+        if double is not None:
+            return self._escape_regex.sub(
+                lambda m: m.group(1) != '\n' and m.group(1) or '', double)
+        if single is not None:
+            return single
+        # An escaped newline is a line continuation
+        return escaped != '\n' and escaped or ''
 
-        """
-        if value.startswith("'") and value.endswith("'"):
-            return value.strip("'")
-        else:
+    def _clean(self, value):
+        """Pythonize a bash string, removing quotes and escapes"""
+        # Most words are unquoted, return those as they are
+        if '"' not in value and "'" not in value and '\\' not in value:
             return value
+        return self._quoted_regex.sub(self._unquote, value)
 
     def _clean_array(self, value):
-        """Pythonize a bash array"""
-        return shlex.split(value.strip('()'))
+        """Pythonize the contents of a bash array"""
+        return [self._clean(x.group('word'))
+            for x in self._word_regex.finditer(value) if x.group('word')]
 
     def _replace_symbol(self, matchobj):
         """Replace a regex-matched variable with its value"""
         symbol = matchobj.group('name').strip("{}")
+        # A reference back into a symbol which is being substituted is
+        # cyclic. Bash would expand it to an empty string, since the variable
+        # is still unset at the time of assignment.
+        if symbol in self._resolving:
+            return ''
+        if symbol in self._symbols and symbol not in self._resolved:
+            self._resolve(symbol)
         # If the symbol isn't found fallback to an empty string, like bash
-        try:
-            value = self._symbols[symbol]
-        except KeyError:
-            value = ''
-        # BUG: Might result in an infinite loop, oops!
-        return self._symbol_regex.sub(self._replace_symbol, value)
+        value = self._symbols.get(symbol, '')
+        # Like bash, an array expands to its first element
+        if not isinstance(value, str):
+            value = value and value[0] or ''
+        return value
+
+    def _substitute_value(self, value):
+        """Substitute bash variables within *value*"""
+        sub = self._symbol_regex.sub
+        replace = self._replace_symbol
+        if isinstance(value, str):
+            return sub(replace, value)
+        return [sub(replace, x) for x in value]
+
+    def _resolve(self, symbol):
+        """Substitute bash variables within the value of *symbol*"""
+        self._resolving.add(symbol)
+        self._symbols[symbol] = self._substitute_value(self._symbols[symbol])
+        self._resolving.discard(symbol)
+        self._resolved.add(symbol)
 
     def _substitute(self):
-        """Substitute all bash variables within values with their values"""
+        """Substitute all bash variables within values with their values
+
+        Symbols are substituted depth first: a variable is fully substituted
+        the first time a value refers to it, so each value is only scanned
+        once. References back into a cycle of symbols which depend on each
+        other expand to an empty string.
+
+        """
         for symbol in self._symbols:
-            value = self._symbols[symbol]
-            # FIXME: This is icky
-            if isinstance(value, str):
-                result = self._symbol_regex.sub(self._replace_symbol, value)
-            else:
-                result = [self._symbol_regex.sub(self._replace_symbol, x)
-                    for x in value]
-            self._symbols[symbol] = result
+            if symbol not in self._resolved:
+                self._resolve(symbol)
 
     def _assign_local(self):
         """Assign values from _symbols to PKGBUILD variables"""
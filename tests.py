@@ -23,6 +23,12 @@
 
 from __future__ import unicode_literals
 
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
 import time
 import unittest
 
@@ -83,6 +89,8 @@ class PackageGenerator(object):
         self.groups = []
         self.licenses = []
         self.architectures = []
+        self.depends = []
+        self.optdepends = []
         self.replaces = []
         self.conflicts = []
         self.provides = []
@@ -231,6 +239,128 @@ class PacmanPackageTest(unittest.TestCase):
         self.assertEqual(self.package.options, target.options)
         self.assertEqual(target.files, [".PKGINFO", "foo.txt"])
 
+    def test_lists_not_shared(self):
+        self.package.licenses = ['MIT']
+        archive = TarFileMock()
+        archive.add(self.package.as_file())
+        parched.PacmanPackage(tarfileobj=archive)
+        archive = TarFileMock()
+        archive.add(self.package.as_file())
+        target = parched.PacmanPackage(tarfileobj=archive)
+        self.assertEqual(['MIT'], target.licenses)
+
+    def test_str(self):
+        archive = TarFileMock()
+        archive.add(self.package.as_file())
+        target = parched.PacmanPackage(tarfileobj=archive)
+        self.assertEqual("test 1.0-1", str(target))
+
+    def test_control_characters(self):
+        self.package.description = "Test\x0cpackage\u2028foo"
+        archive = TarFileMock()
+        archive.add(self.package.as_file())
+        target = parched.PacmanPackage(tarfileobj=archive)
+        self.assertEqual(self.package.description, target.description)
+
+    def test_interned_values(self):
+        self.package.licenses = ['MIT']
+        targets = []
+        for i in range(2):
+            archive = TarFileMock()
+            archive.add(self.package.as_file())
+            targets.append(parched.PacmanPackage(tarfileobj=archive))
+        self.assertTrue(targets[0].licenses[0] is targets[1].licenses[0])
+
+    def test_unknown_variable(self):
+        pkginfo = self.package.as_file()
+        pkginfo.seek(0, 2)
+        pkginfo.write("\npkgbase = test-base\n")
+        archive = TarFileMock()
+        archive.add(pkginfo)
+        target = parched.PacmanPackage(tarfileobj=archive)
+        self.assertEqual("test-base", target.pkgbase)
+
+    def _write_package(self, name, pkginfo=None):
+        """Write the package to a compressed tarball and return its path
+
+        If *pkginfo* is given it is used as the .PKGINFO member instead of
+        the generated one.
+
+        """
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, name)
+        if pkginfo is None:
+            pkginfo = self.package.as_file().getvalue()
+        pkginfo = pkginfo.encode('utf-8')
+        archive = tarfile.open(path, "w:gz")
+        for name, data in ((".PKGINFO", pkginfo), ("foo.txt", b"foo")):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+        archive.close()
+        return path
+
+    def test_package_file(self):
+        """A package is read from a compressed tarball on disk."""
+        self.package.builddate = datetime.utcfromtimestamp(1231575886)
+        self.package.licenses = ['MIT']
+        self.package.depends = ['baz', 'eggs']
+        path = self._write_package("test-1.0-1-any.pkg.tar.gz")
+        target = parched.PacmanPackage(path)
+
+        self.assertEqual(self.package.name, target.name)
+        self.assertEqual(self.package.version, target.version)
+        self.assertEqual(self.package.release, target.release)
+        self.assertEqual(self.package.builddate, target.builddate)
+        self.assertEqual(self.package.licenses, target.licenses)
+        self.assertEqual(self.package.depends, target.depends)
+        self.assertEqual(target.files, [".PKGINFO", "foo.txt"])
+
+    @unittest.skipUnless(hasattr(os, "mkfifo"), "requires named pipes")
+    def test_package_pipe(self):
+        """A package is read from a non-seekable file in stream mode."""
+        path = self._write_package("test-1.0-1-any.pkg.tar.gz")
+        pipe = os.path.join(os.path.dirname(path), "pipe")
+        os.mkfifo(pipe)
+
+        def write():
+            with open(path, "rb") as src, open(pipe, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        writer = threading.Thread(target=write)
+        writer.start()
+        self.addCleanup(writer.join)
+        target = parched.PacmanPackage(pipe)
+        self.assertEqual(self.package.name, target.name)
+
+    def test_lazy_load(self):
+        """A package file is not read until its metadata is accessed."""
+        path = self._write_package("test-1.0-1-any.pkg.tar.gz")
+        target = parched.PacmanPackage(path)
+        os.remove(path)
+        self.assertRaises(IOError, getattr, target, "name")
+        self.assertRaises(IOError, getattr, target, "name")
+        self.assertRaises(IOError, getattr, target, "licenses")
+
+    def test_failed_load(self):
+        """A package which failed to load has no metadata."""
+        self.package.size = 1
+        pkginfo = self.package.as_file().getvalue()
+        path = self._write_package("test-1.0-1-any.pkg.tar.gz",
+            pkginfo.replace("size = 1", "size = abc"))
+        target = parched.PacmanPackage(path)
+        self.assertRaises(ValueError, getattr, target, "name")
+        self.assertRaises(ValueError, getattr, target, "version")
+        self.assertRaises(ValueError, getattr, target, "size")
+
+    def test_parse_many(self):
+        paths = [self._write_package("test-1.0-1-any.pkg.tar.gz")]
+        self.package.version = "2.0"
+        paths.append(self._write_package("test-2.0-1-any.pkg.tar.gz"))
+        targets = parched.PacmanPackage.parse_many(paths, workers=2)
+        self.assertEqual(["1.0", "2.0"], [x.version for x in targets])
+        self.assertEqual(["test", "test"], [x.name for x in targets])
+
 class PKGBUILDTest(unittest.TestCase):
     def setUp(self):
         self.package = PKGBUILDGenerator()
@@ -319,6 +449,38 @@ class PKGBUILDTest(unittest.TestCase):
         target = parched.PKGBUILD(fileobj=pkgbuild)
         self.assertEqual(["Foobar.tar.gz"], target.sources)
 
+    def test_nested_substitution(self):
+        pkgbuild = FileMock("""
+            _pkgname=foo
+            pkgname=${_pkgname}-git
+            source=($pkgname.tar.gz)
+        """)
+        target = parched.PKGBUILD(fileobj=pkgbuild)
+        self.assertEqual("foo-git", target.name)
+        self.assertEqual(["foo-git.tar.gz"], target.sources)
+
+    def test_cyclic_substitution(self):
+        pkgbuild = FileMock("""
+            pkgname=$pkgname
+            _foo=$_bar
+            _bar=$_foo
+        """)
+        target = parched.PKGBUILD(fileobj=pkgbuild)
+        self.assertEqual("", target.name)
+        self.assertEqual("", target._foo)
+        self.assertEqual("", target._bar)
+
+    def test_substitution_through_cycle(self):
+        """Only references back into a cycle expand to an empty string."""
+        pkgbuild = FileMock("""
+            _a=$_a
+            _d=foo
+            _b="$_a$_d"
+            pkgname=$_b-x
+        """)
+        target = parched.PKGBUILD(fileobj=pkgbuild)
+        self.assertEqual("foo-x", target.name)
+
     def test_skip_function(self):
         pkgbuild = FileMock("""
             pkgname=foo
@@ -329,6 +491,33 @@ class PKGBUILDTest(unittest.TestCase):
         target = parched.PKGBUILD(fileobj=pkgbuild)
         self.assertEqual("foo", target.name)
 
+    def test_skip_nested_braces(self):
+        pkgbuild = FileMock("""
+            build() {
+                if true; then { echo '}'; }; fi
+                pkgname=bar
+            }
+            pkgname=foo
+        """)
+        target = parched.PKGBUILD(fileobj=pkgbuild)
+        self.assertEqual("foo", target.name)
+
+    def test_array_comments(self):
+        pkgbuild = FileMock("""
+            depends=('eggs' # (spam)
+                "ham" foo#bar)
+        """)
+        target = parched.PKGBUILD(fileobj=pkgbuild)
+        self.assertEqual(['eggs', 'ham', 'foo#bar'], target.depends)
+
+    def test_unterminated_array(self):
+        """Comments in an unterminated array are parsed in linear time."""
+        pkgbuild = FileMock("pkgname=foo\ndepends=(\n" + "  a # c\n" * 30)
+        start = time.time()
+        target = parched.PKGBUILD(fileobj=pkgbuild)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual("foo", target.name)
+
     def test_quoted_value(self):
         """Right-hand side of assignment in quotes is parsed correctly."""
         self.package.description = "Someone's package"